@@ -6,44 +6,51 @@
 from get_topography import analyze_and_export_metrics 
 from terrain_identifier import get_terrain_classification
 from typing import Dict, Any, List, Optional
-import json # Used for displaying the final structure
+from concurrent.futures import ThreadPoolExecutor
+import orjson # Used for serializing the final structure
 
 # FIX 1: Renamed the function below the main execution block to match the one being imported.
 # FIX 2: Removed the 'include_raw' argument from the function signature.
-def combine_analysis_to_json(db_path: str, image_path: str, pretty: bool = False) -> str:
+def combine_analysis_to_dict(db_path: str, image_path: str) -> Dict[str, Any]:
     """
     Executes the full terrain analysis workflow (quantitative and qualitative),
-    returns the data structure as a JSON string for use by the decision-making AI.
+    returns the data structure as a dict for use by the decision-making AI.
     
     Args:
         db_path (str): Path to the elevation data Excel file.
         image_path (str): Path to the terrain image for classification.
-        pretty (bool): Whether to format the JSON output with indentation.
 
     Returns:
-        str: A JSON string containing all design metrics.
+        dict: All design metrics (values may be NumPy scalars).
     """
     
     print("--- Starting Full Design Data Extraction ---")
 
-    # 1. QUANTITATIVE ANALYSIS (From Elevation Data)
-    quantitative_metrics = analyze_and_export_metrics(
-        file_path=db_path, 
-        output_filename=None 
-    )
+    # The two analyses are independent and both spend their time in C/C++ code
+    # that releases the GIL (pandas/numpy, torch), so overlap them on threads.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # 1. QUANTITATIVE ANALYSIS (From Elevation Data)
+        quantitative_future = executor.submit(
+            analyze_and_export_metrics,
+            file_path=db_path, 
+            output_filename=None 
+        )
+        # 2. QUALITATIVE ANALYSIS (From Image)
+        classification_future = executor.submit(get_terrain_classification, image_path)
+
+        quantitative_metrics = quantitative_future.result()
+
+        terrain_classification_results: List[Dict[str, Any]] = []
+        try:
+            results = classification_future.result()
+            terrain_classification_results = [{'label': item['label'], 'score': item['score']} for item in results]
+        except Exception as e:
+            print(f"\nERROR: Could not run image classification. Details: {e}")
 
     if not quantitative_metrics:
         print("Analysis failed: Quantitative metrics could not be loaded or calculated.")
-        # Return an empty dict string so the AA script doesn't completely fail
-        return json.dumps({"analysis": {"error": "Quantitative metrics failed"}})
-
-    # 2. QUALITATIVE ANALYSIS (From Image)
-    terrain_classification_results: List[Dict[str, Any]] = []
-    try:
-        results = get_terrain_classification(image_path)
-        terrain_classification_results = [{'label': item['label'], 'score': item['score']} for item in results]
-    except Exception as e:
-        print(f"\nERROR: Could not run image classification. Details: {e}")
+        # Return an error dict so the AA script doesn't completely fail
+        return {"analysis": {"error": "Quantitative metrics failed"}}
     
     # 3. DERIVE KEY DESIGN PARAMETERS
     median_obstacle = quantitative_metrics['Median_Vertical_Step_m']
@@ -91,5 +98,22 @@ def combine_analysis_to_json(db_path: str, image_path: str, pretty: bool = False
     
     print("\n--- Design Data Successfully Compiled ---")
     
-    # Return as JSON string
-    return json.dumps(final_data, indent=4 if pretty else None)
+    return final_data
+
+def combine_analysis_to_json(db_path: str, image_path: str, pretty: bool = False) -> str:
+    """
+    Same as combine_analysis_to_dict, serialized as a JSON string.
+    
+    Args:
+        db_path (str): Path to the elevation data Excel file.
+        image_path (str): Path to the terrain image for classification.
+        pretty (bool): Whether to format the JSON output with indentation.
+
+    Returns:
+        str: A JSON string containing all design metrics.
+    """
+    final_data = combine_analysis_to_dict(db_path, image_path)
+
+    # The metrics are NumPy scalars, so let orjson serialize them natively
+    options = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if pretty else 0)
+    return orjson.dumps(final_data, option=options).decode()
@@ -1,21 +1,128 @@
 import pandas as pd
 import numpy as np
+import numexpr
+import math
 import os
-from typing import Optional, Dict, Union
+from typing import Optional, Dict, List, Tuple, Union
+
+try:
+    import numba
+except ImportError:  # numba is optional; the NumPy/numexpr path is used without it
+    numba = None
+
+# Below this many points the vectorized path is already fast and skips the JIT compile
+NUMBA_MIN_POINTS = 100_000
 
 def haversine_distance(lat1_rad, lon1_rad, lat2_rad, lon2_rad, earth_radius_m=6371000):
     """
     Calculates the Haversine distance between two points (in radians) on Earth.
     Returns the distance in meters.
+
+    Expects NumPy arrays; the trig kernel is fused by numexpr into a single pass
+    and the remaining ufuncs run in-place to avoid temporary arrays.
     """
-    delta_lat = lat2_rad - lat1_rad
-    delta_lon = lon2_rad - lon1_rad
-    
-    a = np.sin(delta_lat / 2)**2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(delta_lon / 2)**2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    
-    distance = earth_radius_m * c
-    return distance
+    a = numexpr.evaluate(
+        "sin((lat2_rad - lat1_rad) / 2)**2"
+        " + cos(lat1_rad) * cos(lat2_rad) * sin((lon2_rad - lon1_rad) / 2)**2"
+    )
+    # Clamp rounding error so arcsin stays in its domain
+    np.minimum(a, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * earth_radius_m
+    return a
+
+if numba is not None:
+    # fastmath without 'nnan'/'ninf' so NaN elevation/coordinates are still filtered correctly
+    @numba.njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+    def _step_kernel(lat_rad, lon_rad, z, min_step_m, earth_radius_m):
+        """Fused Haversine + dZ + slope over consecutive points in one parallel pass."""
+        n = lat_rad.size - 1
+        slope = np.empty(n)
+        dz_abs = np.empty(n)
+        keep = np.empty(n, dtype=np.bool_)
+        for i in numba.prange(n):
+            j = i + 1
+            a = (math.sin((lat_rad[j] - lat_rad[i]) / 2)**2
+                 + math.cos(lat_rad[i]) * math.cos(lat_rad[j]) * math.sin((lon_rad[j] - lon_rad[i]) / 2)**2)
+            if a > 1.0:
+                a = 1.0
+            d = 2 * earth_radius_m * math.asin(math.sqrt(a))
+            dz = abs(z[j] - z[i])
+            keep[i] = d >= min_step_m
+            slope[i] = dz / d if keep[i] else 0.0
+            dz_abs[i] = dz
+        return slope[keep], dz_abs[keep]
+
+def compute_steps(
+    lat_rad: np.ndarray,
+    lon_rad: np.ndarray,
+    z: np.ndarray,
+    min_step_m: float,
+    earth_radius_m: float = 6371000
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Computes absolute slope (m/m) and absolute vertical step (m) between consecutive
+    points, dropping steps whose horizontal distance is below min_step_m.
+
+    Large inputs use the parallel numba kernel when numba is installed.
+    """
+    if numba is not None and lat_rad.size >= NUMBA_MIN_POINTS:
+        return _step_kernel(lat_rad, lon_rad, z, float(min_step_m), float(earth_radius_m))
+
+    # Consecutive points are compared through zero-copy slices ([:-1] = previous, [1:] = current)
+    d_horizontal = haversine_distance(
+        lat_rad[:-1], lon_rad[:-1],
+        lat_rad[1:], lon_rad[1:],
+        earth_radius_m
+    )
+    dz = np.diff(z)
+
+    mask = d_horizontal >= min_step_m
+    dz_abs = dz[mask]
+    np.abs(dz_abs, out=dz_abs)
+    # d_horizontal[mask] is a fresh array we no longer need, so reuse it for the slope
+    slope = d_horizontal[mask]
+    np.divide(dz_abs, slope, out=slope)
+    return slope, dz_abs
+
+def summarize_steps(values: np.ndarray) -> Tuple[float, float, float]:
+    """
+    Returns (max, median, mean) of a per-step metric, ignoring NaNs.
+
+    NaNs are dropped once up front so the three reductions run on one compact
+    array; np.median uses introselect (O(N)). Empty input yields 0.0 for all three.
+    """
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return 0.0, 0.0, 0.0
+    return float(values.max()), float(np.median(values)), float(values.mean())
+
+def load_elevation_data(file_path: str, required_cols: List[str]) -> pd.DataFrame:
+    """
+    Loads the elevation Excel file, using a '<file_path>.parquet' sidecar cache.
+
+    The cache is only trusted when it is at least as new as the Excel file, so
+    editing the spreadsheet invalidates it. Only the required columns are cached.
+    """
+    cache_path = file_path + '.parquet'
+    source_mtime = os.path.getmtime(file_path)
+
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= source_mtime:
+        try:
+            return pd.read_parquet(cache_path, columns=required_cols, engine='pyarrow')
+        except Exception as e:
+            print(f"WARNING: Ignoring unreadable cache '{cache_path}'. Error details: {e}")
+
+    df = pd.read_excel(file_path)
+
+    if all(col in df.columns for col in required_cols):
+        try:
+            df[required_cols].to_parquet(cache_path, engine='pyarrow', compression='zstd')
+        except Exception as e:
+            print(f"WARNING: Could not write the cache file '{cache_path}'. Error details: {e}")
+
+    return df
 
 def analyze_and_export_metrics(
     file_path: str, 
@@ -35,9 +142,10 @@ def analyze_and_export_metrics(
     
     print(f"--- Initiating Robust Quantitative Terrain Analysis for: {os.path.basename(file_path)} ---")
     
-    # 1. Load the data
+    # 1. Load the data (from the Parquet sidecar cache when it is up to date)
+    required_cols = [lon_col, lat_col, z_col, id_col]
     try:
-        df = pd.read_excel(file_path)
+        df = load_elevation_data(file_path, required_cols)
     except FileNotFoundError:
         print(f"ERROR: We couldn't locate the file at '{file_path}'. Please verify the path and file name.")
         return None
@@ -46,64 +154,36 @@ def analyze_and_export_metrics(
         return None
         
     # Check for empty data or missing columns
-    required_cols = [lon_col, lat_col, z_col, id_col]
     if df.empty or not all(col in df.columns for col in required_cols):
         print(f"ERROR: Data is empty or missing required columns ({', '.join(required_cols)}).")
         return None
 
     # --- Step 1: Calculate True Distance and Slope ---
     
-    # Sort by the ID column to process points in their intended sequence
-    df = df.sort_values(by=id_col).reset_index(drop=True)
-    
-    # Get previous point's data using .shift()
-    df['prev_lat'] = df[lat_col].shift(1)
-    df['prev_lon'] = df[lon_col].shift(1)
+    # Sort by the ID column to process points in their intended sequence.
+    # Only the three coordinate arrays are reordered; the DataFrame is never copied.
+    order = np.argsort(df[id_col].to_numpy(), kind='stable')
     
-    # Convert degrees to radians for Haversine calculation
-    df['lat_rad'] = np.radians(df[lat_col])
-    df['lon_rad'] = np.radians(df[lon_col])
-    df['prev_lat_rad'] = np.radians(df['prev_lat'])
-    df['prev_lon_rad'] = np.radians(df['prev_lon'])
-    
-    # Calculate true horizontal distance (d_horizontal) and vertical change (dZ)
-    df['d_horizontal_m'] = haversine_distance(
-        df['prev_lat_rad'], df['prev_lon_rad'],
-        df['lat_rad'], df['lon_rad']
-    )
-    df['dZ_m'] = df[z_col].diff()
+    # Work on the raw float64 arrays (no intermediate DataFrame columns)
+    lat_rad = np.radians(df[lat_col].to_numpy(dtype=np.float64)[order])
+    lon_rad = np.radians(df[lon_col].to_numpy(dtype=np.float64)[order])
+    z = df[z_col].to_numpy(dtype=np.float64)[order]
     
-    # --- Data Cleaning: Filter out 0-distance steps ---
+    # Calculate true horizontal distance and vertical change (dZ), then the
+    # absolute slope (rise/run = dZ / d_horizontal).
+    # Data Cleaning: 0-distance steps are filtered out inside compute_steps.
     MIN_HORIZONTAL_STEP_M = 0.01 # 1 centimeter threshold
-    df_cleaned = df[df['d_horizontal_m'] >= MIN_HORIZONTAL_STEP_M].copy()
-
-    # Calculate the absolute slope (rise/run = dZ / d_horizontal)
-    df_cleaned['Absolute_Slope'] = (df_cleaned['dZ_m'] / df_cleaned['d_horizontal_m']).abs()
+    slope, dz_abs = compute_steps(lat_rad, lon_rad, z, MIN_HORIZONTAL_STEP_M)
+    filtered_points = len(df) - slope.size
     
     # --- Step 2: Calculate Slope Metrics (Mean, Median, Max) ---
-    max_slope_value = df_cleaned['Absolute_Slope'].max()
-    median_abs_slope = df_cleaned['Absolute_Slope'].median()
-    mean_abs_slope = df_cleaned['Absolute_Slope'].mean()
+    max_slope_value, median_abs_slope, mean_abs_slope = summarize_steps(slope)
     
     # --- Step 3: Obstacle Analysis (Mean, Median, Max Roughness) ---
-    # We use the original 'df' for dZ_m to capture all vertical steps
-
-    df_cleaned['dZ_m_abs'] = df_cleaned['dZ_m'].abs()
-    max_vertical_step = df_cleaned['dZ_m_abs'].max()
-    median_vertical_step = df_cleaned['dZ_m_abs'].median()
-    mean_vertical_step = df_cleaned['dZ_m_abs'].mean()
+    max_vertical_step, median_vertical_step, mean_vertical_step = summarize_steps(dz_abs)
 
     # --- Step 4: Compile and Format Results ---
     
-    # Ensure all calculated metrics are treated as floats, handling potential NaNs safely
-    max_slope_value = max_slope_value if not pd.isna(max_slope_value) else 0.0
-    median_abs_slope = median_abs_slope if not pd.isna(median_abs_slope) else 0.0
-    mean_abs_slope = mean_abs_slope if not pd.isna(mean_abs_slope) else 0.0
-    
-    max_vertical_step = max_vertical_step if not pd.isna(max_vertical_step) else 0.0
-    median_vertical_step = median_vertical_step if not pd.isna(median_vertical_step) else 0.0
-    mean_vertical_step = mean_vertical_step if not pd.isna(mean_vertical_step) else 0.0
-
     # Convert slope ratio (m/m) to standard engineering units
     max_grade_percent = max_slope_value * 100
     max_grade_angle = np.degrees(np.arctan(max_slope_value))
@@ -128,7 +208,7 @@ def analyze_and_export_metrics(
     
     output_lines = [
         f"\n--- Final Engineering Metrics for Wheel Design ---",
-        f"Data Anomalies Filtered (Horizontal Step < {MIN_HORIZONTAL_STEP_M}m): {len(df) - len(df_cleaned)} points",
+        f"Data Anomalies Filtered (Horizontal Step < {MIN_HORIZONTAL_STEP_M}m): {filtered_points} points",
         f"1. Slope (Grade) Metrics:",
         f"   - **MEAN Grade (Average):** {mean_grade_percent:.2f}% (Average expected load)",
         f"   - **ROBUST Grade (Median):** {median_grade_percent:.2f}% (Best for general power/efficiency - less sensitive to extremes)",
@@ -1,15 +1,22 @@
 import os
-import json
-import base64
+import mmap
+import functools
+import hashlib
+import time
 import logging
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import orjson
+import pybase64
+import fastjsonschema
 from dotenv import load_dotenv
 import google.generativeai as genai  # <-- Import Google
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from mimetypes import guess_type
+from typing import Dict, List, Optional, Tuple
 
-# Assuming 'combine_analysis_to_json' is in a file named 'w.py'
-from assembler import combine_analysis_to_json 
+from assembler import combine_analysis_to_dict
 
 # ---- Configuration ----
 load_dotenv()
@@ -26,6 +33,48 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise RuntimeError("GOOGLE_API_KEY is required in your .env")
 
+# Configure the Google client once per process
+genai.configure(api_key=GOOGLE_API_KEY)
+
+# --- Gemini context cache for the (static) system prompt ---
+PROMPT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".wheel-sync", "cache.json")
+PROMPT_CACHE_TTL = timedelta(hours=1)
+# Stop handing out a cache handle this long before it expires, so in-flight requests don't hit a deleted cache
+PROMPT_CACHE_REFRESH_MARGIN = timedelta(minutes=1)
+
+# In-process memo of GenerativeModel handles: (model_name, ai_prompt) -> (model, cache expire_time)
+_MODEL_MEMO_SIZE = 4
+_model_memo: Dict[Tuple[str, str], Tuple[genai.GenerativeModel, Optional[datetime]]] = {}
+
+# --- Gemini Batch Mode (used when main() is given several jobs) ---
+BATCH_POLL_INTERVAL_S = 30
+BATCH_TIMEOUT_S = 24 * 60 * 60  # Batch Mode's own turnaround target
+BATCH_TERMINAL_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# --- Model output schema (compiled once at import) ---
+DESIGN_KEYS = ["Tread_Spacing", "Tire_Thickness", "Tire_OD", "Tread_Thickness"]
+_NON_EMPTY_STRING = {"type": "string", "pattern": r"\S"}  # a non-empty string with units
+OUTPUT_SCHEMA = {
+    "type": "object",
+    "required": DESIGN_KEYS + ["reasoning"],
+    "properties": {**{key: _NON_EMPTY_STRING for key in DESIGN_KEYS}, "reasoning": {}},
+}
+_validate_output = fastjsonschema.compile(OUTPUT_SCHEMA)
+
+class LazyPreview:
+    """
+    Single-line preview of a long string for %s log arguments. The slice and
+    newline replacement only happen if a handler actually formats the record.
+    """
+    __slots__ = ("text", "length")
+
+    def __init__(self, text: str, max_len: int):
+        self.text = text
+        self.length = min(max_len, len(text))
+
+    def __str__(self) -> str:
+        return self.text[:self.length].replace("\n", " ")
+
 def load_env_prompt() -> str:
     p = os.getenv("AI_PROMPT")
     if not p:
@@ -33,36 +82,41 @@ def load_env_prompt() -> str:
     return p
 
 def encode_image_base64(image_path: str) -> str:
-    """Encodes the image to base64."""
+    """Encodes the image to base64 (SIMD-accelerated, straight from a memory map)."""
     with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return pybase64.b64encode_as_string(mm)
 
-def build_user_context_json(db_path: str, image_path: str) -> str:
+def utc_timestamp() -> str:
+    """Current UTC time as an ISO-8601 string with millisecond precision and a 'Z' suffix."""
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+def build_user_context_json(db_path: str, image_path: str, generated_at: Optional[str] = None) -> str:
     """
     Creates the user-facing JSON context string.
+    Pass generated_at to share one provenance timestamp across a batch.
     """
-    # Get the analysis data
-    combined_json_str = combine_analysis_to_json(db_path, image_path, pretty=False)
-    try:
-        combined_json = json.loads(combined_json_str) if isinstance(combined_json_str, str) else combined_json_str
-    except Exception:
-        combined_json = combined_json_str
+    # Get the analysis data as a dict so the payload is serialized only once
+    combined_analysis = combine_analysis_to_dict(db_path, image_path)
 
     # Build the payload structure
     user_payload = {
         "context_provenance": {
-            "generated_at": datetime.utcnow().isoformat() + "Z",
+            "generated_at": generated_at or utc_timestamp(),
             "db_path": db_path,
             "image_path": image_path
         },
-        "analysis": combined_json
+        "analysis": combined_analysis
     }
-    user_text = json.dumps(user_payload, ensure_ascii=False)
+    # orjson always emits UTF-8, which matches ensure_ascii=False
+    user_text = orjson.dumps(user_payload, option=orjson.OPT_SERIALIZE_NUMPY).decode()
     
     # Log info
-    preview_len = min(2048, len(user_text))
+    preview = LazyPreview(user_text, 2048)
     logger.info("USER CONTEXT JSON length: %d chars", len(user_text))
-    logger.info("USER CONTEXT JSON preview (first %d chars): %s", preview_len, user_text[:preview_len].replace("\n", " "))
+    logger.info("USER CONTEXT JSON preview (first %d chars): %s", preview.length, preview)
     
     return user_text
 
@@ -84,7 +138,7 @@ def extract_text_from_response(resp) -> str:
     # last resort: stringify entire response
     logger.error("Could not parse response text directly.")
     try:
-        return json.dumps(resp, default=str)
+        return orjson.dumps(resp, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
     except Exception:
         return str(resp)
 
@@ -97,80 +151,229 @@ def validate_and_parse_json(text: str) -> dict:
     Ensure the model returned a single JSON object. Raises ValueError on parse issues.
     This version expects design values to be strings (e.g., "30 mm").
     """
-    # Trim whitespace and extract the JSON block (this part is now correct)
+    # Common case: the output is already bare JSON, so parse it in one C-level pass
     txt = text.strip()
-    first = txt.find("{")
-    last = txt.rfind("}")
+    try:
+        parsed = orjson.loads(txt)
+    except orjson.JSONDecodeError:
+        # Fall back to extracting the JSON block from surrounding text/code fences
+        first = txt.find("{")
+        last = txt.rfind("}")
 
-    if first == -1 or last == -1 or last <= first:
-        raise ValueError("Model output does not contain a valid JSON object.")
-        
-    txt = txt[first:last+1]
-    
-    parsed = json.loads(txt)
-    if not isinstance(parsed, dict):
-        raise ValueError("Parsed JSON is not an object.")
-    
-    # --- Key validation remains the same and is correct ---
-    required_keys = {"Tread_Spacing", "Tire_Thickness", "Tire_OD", "Tread_Thickness", "reasoning"}
-    missing = required_keys - set(parsed.keys())
-    if missing:
-        raise ValueError(f"JSON missing required keys: {missing}")
+        if first == -1 or last == -1 or last <= first:
+            raise ValueError("Model output does not contain a valid JSON object.")
+            
+        parsed = orjson.loads(txt[first:last+1])
     
-    # --- CRITICAL CHANGE: We now check if the values are strings, not numbers. ---
-    design_keys = ["Tread_Spacing", "Tire_Thickness", "Tire_OD", "Tread_Thickness"]
-    for key in design_keys:
-        value = parsed.get(key)
-        if not isinstance(value, str) or not value.strip():
-             raise ValueError(f"Design key '{key}' must be a non-empty string with units.")
+    # --- Key/value validation via the precompiled schema ---
+    # Design values are checked as non-empty strings (with units), not numbers.
+    try:
+        _validate_output(parsed)
+    except fastjsonschema.JsonSchemaException as e:
+        raise ValueError(f"Model JSON does not match the expected schema: {e.message}") from e
              
     # NOTE: The explicit check for 360 divisibility is removed since the value is a string.
     # We must trust the AI to perform that calculation based on the prompt instructions.
          
     return parsed
 
-def main():
+def _load_prompt_cache_index() -> dict:
     try:
-        # 1. Configure the Google client
-        genai.configure(api_key=GOOGLE_API_KEY)
-        
-        # 2. Load the system prompt
+        with open(PROMPT_CACHE_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except Exception:
+        return {}
+
+def _save_prompt_cache_index(index: dict) -> None:
+    try:
+        os.makedirs(os.path.dirname(PROMPT_CACHE_FILE), exist_ok=True)
+        with open(PROMPT_CACHE_FILE, "wb") as f:
+            f.write(orjson.dumps(index))
+    except Exception as e:
+        logger.warning("Could not write prompt cache index '%s': %s", PROMPT_CACHE_FILE, e)
+
+def build_model(ai_prompt: str, model_name: str = MODEL) -> Tuple[genai.GenerativeModel, Optional[datetime]]:
+    """
+    Returns a GenerativeModel whose system instruction is served from a Gemini
+    CachedContent, re-using the cache handle across runs until its TTL expires.
+    Falls back to a plain GenerativeModel if caching is unavailable. A prompt the
+    API rejects (e.g. below the model's minimum cacheable size) is recorded as
+    uncacheable for one TTL period so later runs skip the failing create() round-trip.
+
+    Returns the model and the time its CachedContent expires (None when uncached).
+    """
+    key = hashlib.sha256(f"{model_name}\n{ai_prompt}".encode("utf-8")).hexdigest()
+    index = _load_prompt_cache_index()
+    now = datetime.now(timezone.utc)
+
+    entry = index.get(key)
+    if entry and entry.get("uncacheable") and datetime.fromisoformat(entry["expire_time"]) > now:
+        return genai.GenerativeModel(model_name, system_instruction=ai_prompt), None
+
+    if entry and not entry.get("uncacheable") and datetime.fromisoformat(entry["expire_time"]) > now + PROMPT_CACHE_REFRESH_MARGIN:
+        try:
+            cached = caching.CachedContent.get(entry["name"])
+            logger.info("Re-using cached system prompt: %s", cached.name)
+            return genai.GenerativeModel.from_cached_content(cached_content=cached), datetime.fromisoformat(entry["expire_time"])
+        except Exception as e:
+            logger.info("Cached system prompt %s is no longer available: %s", entry["name"], e)
+
+    try:
+        cached = caching.CachedContent.create(
+            model=model_name,
+            system_instruction=ai_prompt,
+            ttl=PROMPT_CACHE_TTL
+        )
+    except google_exceptions.InvalidArgument as e:
+        # Usually the prompt is below the minimum cacheable size, but a bad key or model
+        # name is also INVALID_ARGUMENT, so only skip create() for one TTL period
+        logger.warning("System prompt cannot be cached, sending it uncached for %s: %s", PROMPT_CACHE_TTL, e)
+        index[key] = {"uncacheable": True, "expire_time": (now + PROMPT_CACHE_TTL).isoformat()}
+        _save_prompt_cache_index(index)
+        return genai.GenerativeModel(model_name, system_instruction=ai_prompt), None
+    except Exception as e:
+        logger.warning("Prompt caching unavailable, sending system prompt uncached: %s", e)
+        return genai.GenerativeModel(model_name, system_instruction=ai_prompt), None
+
+    expire_time = now + PROMPT_CACHE_TTL
+    index[key] = {"name": cached.name, "expire_time": expire_time.isoformat()}
+    _save_prompt_cache_index(index)
+    logger.info("Created cached system prompt: %s", cached.name)
+    return genai.GenerativeModel.from_cached_content(cached_content=cached), expire_time
+
+def _get_model(model_name: str, ai_prompt: str) -> genai.GenerativeModel:
+    """
+    Memoized build_model() so repeated main() calls in one process skip model and
+    cache-handle setup. A model tied to a CachedContent is rebuilt shortly before
+    that cache expires, so the handle never outlives the server-side cache.
+    """
+    key = (model_name, ai_prompt)
+    memo = _model_memo.get(key)
+    if memo is not None:
+        model, expire_time = memo
+        if expire_time is None or datetime.now(timezone.utc) + PROMPT_CACHE_REFRESH_MARGIN < expire_time:
+            return model
+
+    model, expire_time = build_model(ai_prompt, model_name)
+    _model_memo.pop(key, None)
+    _model_memo[key] = (model, expire_time)
+    if len(_model_memo) > _MODEL_MEMO_SIZE:
+        _model_memo.pop(next(iter(_model_memo)))
+    return model
+
+@functools.lru_cache(maxsize=1)
+def _get_batch_client():
+    """Creates the google-genai client used for Batch Mode once per process."""
+    try:
+        from google import genai as google_genai  # Batch Mode lives in the google-genai SDK
+    except ImportError as e:
+        raise RuntimeError("Batch mode requires the 'google-genai' package (pip install google-genai).") from e
+    return google_genai.Client(api_key=GOOGLE_API_KEY)
+
+def run_batch(ai_prompt: str, user_context_texts: List[str]) -> List[str]:
+    """
+    Submits all user contexts as one inline Gemini Batch Mode job, waits for it
+    to finish and returns the raw response text for each request, in order.
+    Failed requests yield an empty string so they fail validation downstream.
+    """
+    client = _get_batch_client()
+    inline_requests = [
+        {
+            "contents": [{"role": "user", "parts": [{"text": text}]}],
+            "config": {"system_instruction": {"parts": [{"text": ai_prompt}]}},
+        }
+        for text in user_context_texts
+    ]
+
+    batch_job = client.batches.create(
+        model=MODEL,
+        src=inline_requests,
+        config={"display_name": f"wheel-sync-{len(inline_requests)}-jobs"}
+    )
+    logger.info("Submitted batch job %s with %d requests.", batch_job.name, len(inline_requests))
+
+    deadline = time.monotonic() + BATCH_TIMEOUT_S
+    while batch_job.state.name not in BATCH_TERMINAL_STATES:
+        if time.monotonic() >= deadline:
+            try:
+                client.batches.cancel(name=batch_job.name)
+            except Exception as e:
+                logger.warning("Could not cancel batch job %s: %s", batch_job.name, e)
+            raise RuntimeError(f"Batch job {batch_job.name} still {batch_job.state.name} after {BATCH_TIMEOUT_S}s; cancelled.")
+        logger.info("Batch job %s is %s; polling again in %ds...", batch_job.name, batch_job.state.name, BATCH_POLL_INTERVAL_S)
+        time.sleep(BATCH_POLL_INTERVAL_S)
+        batch_job = client.batches.get(name=batch_job.name)
+
+    if batch_job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {batch_job.name} finished with state {batch_job.state.name}: {batch_job.error}")
+
+    texts = []
+    for i, inline_response in enumerate(batch_job.dest.inlined_responses):
+        if inline_response.response:
+            texts.append(extract_text_from_response(inline_response.response))
+        else:
+            logger.error("Batch request %d failed: %s", i, inline_response.error)
+            texts.append("")
+
+    if len(texts) != len(user_context_texts):
+        raise RuntimeError(f"Batch job {batch_job.name} returned {len(texts)} responses for {len(user_context_texts)} requests.")
+    return texts
+
+def main(jobs: Optional[List[Tuple[str, str]]] = None):
+    """
+    Runs the pipeline for each (db_path, image_path) job. A single job (the
+    default, taken from DB_PATH/IMAGE_PATH) uses a synchronous request; several
+    jobs are sent together through Gemini Batch Mode.
+    """
+    if not jobs:
+        jobs = [(DB_PATH, IMAGE_PATH)]
+
+    try:
+        # 1./2. The Google client is configured at import; load the system prompt
         ai_prompt = load_env_prompt()
         logger.info("SYSTEM PROMPT (AI_PROMPT): %s", ai_prompt)
-        
-        # 3. Set up the GenerativeModel with the system prompt
-        model = genai.GenerativeModel(
-            MODEL,
-            system_instruction=ai_prompt
-        )
 
-        # 4. Prepare the user content (JSON text ONLY)
-        user_context_text = build_user_context_json(DB_PATH, IMAGE_PATH)
+        # 3. Prepare the user content (JSON text ONLY) for every job
+        generated_at = utc_timestamp()
+        user_context_texts = [build_user_context_json(db_path, image_path, generated_at) for db_path, image_path in jobs]
         
         # --- IMAGE CODE REMOVED ---
         # All the code for loading the image,
         # guessing mime_type, and creating image_part
         # has been deleted as requested.
         
-        # 5. Send synchronous request to model
-        logger.info("Sending synchronous request to model (%s)...", MODEL)
-        
-        # --- UPDATED CALL ---
-        # We now send *only* the text context, not a list.
-        resp = model.generate_content(user_context_text)
-        
-        logger.info("Response received; extracting text...")
-        text = extract_text_from_response(resp)
+        if len(jobs) == 1:
+            # 4. Get the (memoized) GenerativeModel with the cached system prompt
+            model = _get_model(MODEL, ai_prompt)
 
-        logger.info("Raw model output (trimmed preview): %s", text[:200].replace("\n", " "))
-        try:
-            parsed = validate_and_parse_json(text)
-            # Print pretty JSON to stdout for pipeline consumption
-            print(json.dumps(parsed, indent=2, ensure_ascii=False))
-        except Exception as e:
-            logger.error("Failed to validate/parse model JSON: %s", str(e))
-            logger.debug("Full model output:\n%s", text)
-            raise
+            # 5. Send synchronous request to model
+            logger.info("Sending synchronous request to model (%s)...", MODEL)
+            
+            # --- UPDATED CALL ---
+            # We now send *only* the text context, not a list.
+            resp = model.generate_content(user_context_texts[0])
+            
+            logger.info("Response received; extracting text...")
+            texts = [extract_text_from_response(resp)]
+        else:
+            # 4./5. Offline multi-site study: one batch job at the discounted batch rate
+            logger.info("Sending %d requests to model (%s) via batch mode...", len(jobs), MODEL)
+            texts = run_batch(ai_prompt, user_context_texts)
+
+        failures = 0
+        for (db_path, image_path), text in zip(jobs, texts, strict=True):
+            logger.info("Raw model output for %s (trimmed preview): %s", db_path, LazyPreview(text, 200))
+            try:
+                parsed = validate_and_parse_json(text)
+                # Print pretty JSON to stdout for pipeline consumption
+                print(orjson.dumps(parsed, option=orjson.OPT_INDENT_2).decode())
+            except Exception as e:
+                failures += 1
+                logger.error("Failed to validate/parse model JSON for %s: %s", db_path, str(e))
+                logger.debug("Full model output:\n%s", text)
+
+        if failures:
+            raise RuntimeError(f"{failures} of {len(jobs)} model responses failed validation.")
 
     except Exception as exc:
         logger.error("Pipeline failed: %s", str(exc))
@@ -1,16 +1,138 @@
-from transformers import pipeline
-from typing import List, Dict, Any
+import os
+import time
+import functools
+import orjson
+from collections import OrderedDict
+import torch
+from transformers import AutoImageProcessor, pipeline
+from typing import List, Dict, Any, Optional, Tuple
 
-def get_terrain_classification(image_path: str) -> List[Dict[str, Any]]:
+MODEL_NAME = "smp111/terrain_recognition"
+
+# Dynamic int8 ONNX Runtime export of MODEL_NAME, used for CPU inference (built on first use)
+QUANTIZED_MODEL_DIR = os.getenv(
+    "TERRAIN_INT8_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "terrain_int8")
+)
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+
+# A failed export is recorded here so later processes go straight to PyTorch instead of
+# re-running it; it is retried after QUANTIZED_EXPORT_RETRY_S (or delete the file).
+QUANTIZED_EXPORT_FAILURE_FILE = os.path.join(os.path.expanduser("~"), ".wheel-sync", "terrain_int8_export_failed.json")
+QUANTIZED_EXPORT_RETRY_S = 24 * 60 * 60
+
+# Classification results keyed on (image_path, mtime, top_k) so re-runs on an unchanged image skip the forward pass
+_RESULT_CACHE_SIZE = 32
+_result_cache: "OrderedDict[Tuple[str, float, Optional[int]], List[Dict[str, Any]]]" = OrderedDict()
+
+def _nearest_existing_dir(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path
+
+def _recent_export_failure() -> Optional[str]:
+    """Returns the recorded export error for QUANTIZED_MODEL_DIR if it is still within the retry window."""
+    try:
+        with open(QUANTIZED_EXPORT_FAILURE_FILE, "rb") as f:
+            record = orjson.loads(f.read())
+    except Exception:
+        return None
+    if (record.get("model") == MODEL_NAME and record.get("dir") == QUANTIZED_MODEL_DIR
+            and time.time() - record.get("failed_at", 0) < QUANTIZED_EXPORT_RETRY_S):
+        return record.get("error")
+    return None
+
+def _record_export_failure(error: Exception) -> None:
+    try:
+        os.makedirs(os.path.dirname(QUANTIZED_EXPORT_FAILURE_FILE), exist_ok=True)
+        with open(QUANTIZED_EXPORT_FAILURE_FILE, "wb") as f:
+            f.write(orjson.dumps({"model": MODEL_NAME, "dir": QUANTIZED_MODEL_DIR, "failed_at": time.time(), "error": str(error)}))
+    except Exception as e:
+        print(f"WARNING: Could not record the int8 export failure in '{QUANTIZED_EXPORT_FAILURE_FILE}'. Error details: {e}")
+
+def _export_quantized_model() -> None:
+    """Exports MODEL_NAME to ONNX and dynamically quantizes it to int8 in QUANTIZED_MODEL_DIR."""
+    from optimum.onnxruntime import ORTModelForImageClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    if not os.access(_nearest_existing_dir(QUANTIZED_MODEL_DIR), os.W_OK):
+        raise PermissionError(f"'{QUANTIZED_MODEL_DIR}' is not writable; set TERRAIN_INT8_DIR to a writable directory.")
+
+    print(f"Exporting '{MODEL_NAME}' to int8 ONNX in '{QUANTIZED_MODEL_DIR}' (one-time)...")
+    onnx_model = ORTModelForImageClassification.from_pretrained(MODEL_NAME, export=True)
+    onnx_model.save_pretrained(QUANTIZED_MODEL_DIR)
+    AutoImageProcessor.from_pretrained(MODEL_NAME).save_pretrained(QUANTIZED_MODEL_DIR)
+
+    quantizer = ORTQuantizer.from_pretrained(onnx_model)
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=QUANTIZED_MODEL_DIR, quantization_config=quantization_config)
+
+def _load_quantized_model():
+    """
+    Loads the int8 ONNX Runtime model, exporting and quantizing MODEL_NAME into
+    QUANTIZED_MODEL_DIR the first time. Requires optimum[onnxruntime].
+    A failed export is not retried by later processes until QUANTIZED_EXPORT_RETRY_S passes.
+    """
+    from optimum.onnxruntime import ORTModelForImageClassification
+
+    if not os.path.exists(os.path.join(QUANTIZED_MODEL_DIR, QUANTIZED_MODEL_FILE)):
+        previous_error = _recent_export_failure()
+        if previous_error is not None:
+            raise RuntimeError(f"skipping export, it failed recently ({previous_error}); "
+                               f"delete '{QUANTIZED_EXPORT_FAILURE_FILE}' to retry now")
+        try:
+            _export_quantized_model()
+        except Exception as e:
+            _record_export_failure(e)
+            raise
+
+    return ORTModelForImageClassification.from_pretrained(QUANTIZED_MODEL_DIR, file_name=QUANTIZED_MODEL_FILE)
+
+@functools.lru_cache(maxsize=1)
+def _get_classifier():
+    """
+    Builds the image-classification pipeline once per process (weights load + runtime init).
+    On CPU the int8 ONNX Runtime model is preferred; on GPU, or if optimum is not
+    available, the FP32 PyTorch model is used.
+    """
+    if not torch.cuda.is_available():
+        try:
+            return pipeline(
+                "image-classification",
+                model=_load_quantized_model(),
+                image_processor=AutoImageProcessor.from_pretrained(QUANTIZED_MODEL_DIR)
+            )
+        except Exception as e:
+            print(f"WARNING: int8 ONNX classifier unavailable, using the PyTorch model. Details: {e}")
+
+    return pipeline(
+        "image-classification",
+        model=MODEL_NAME,
+        device=0 if torch.cuda.is_available() else -1
+    )
+
+def get_terrain_classification(image_path: str, top_k: Optional[int] = None) -> List[Dict[str, Any]]:
     """
     Performs image classification on the terrain image to identify surface types.
     This function strictly returns raw data (labels and scores).
+    Pass top_k to limit the result to the best k labels (None keeps the pipeline default).
     """
     # Note: Ensure you have PyTorch or TensorFlow installed to run this pipeline.
     try:
-        classifier = pipeline("image-classification", model="smp111/terrain_recognition")
+        key = (os.path.abspath(image_path), os.path.getmtime(image_path), top_k)
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+            return list(_result_cache[key])
+
+        classifier = _get_classifier()
         # The output is a list of dictionaries: [{'label': 'marshy', 'score': 0.47}, ...]
-        return classifier(image_path)
+        results = classifier(image_path) if top_k is None else classifier(image_path, top_k=top_k)
+
+        _result_cache[key] = results
+        if len(_result_cache) > _RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+        return list(results)
     except Exception as e:
         print(f"ERROR in image classification: {e}")
-        return []
\ No newline at end of file
+        return []